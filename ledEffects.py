@@ -0,0 +1,271 @@
+"""Note-triggered LED effects (ripples, comets, sparkles) built on a fixed-size particle pool."""
+
+import random
+import threading
+
+# Effect options
+effects = ['none', 'ripple', 'comet', 'sparkle']
+beatEffects = ['none', 'pulse', 'strobe', 'cycle']
+
+# Particle kinds
+RIPPLE = 0
+COMET = 1
+SPARKLE = 2
+
+# Defaults
+POOL_SIZE = 512
+RIPPLE_SPEED = 40.0     # LEDs per second at max velocity
+RIPPLE_WIDTH = 3.0      # LEDs either side of the ripple front
+COMET_SPEED = 80.0
+COMET_TAIL = 12.0       # LEDs behind the comet head
+MAX_SPARKLES = 12       # Sparkles spawned at max velocity
+SPARKLE_SPREAD = 6      # LEDs either side of the pressed key
+PULSE_LEVEL = 0.5       # Brightness of the beat pulse at the start of the beat
+STROBE_TIME = 0.03      # Seconds the strobe stays on
+CYCLE_LEVEL = 0.25      # Brightness of the colour cycle background
+
+
+class ParticlePool:
+    # Particles are stored as parallel, preallocated lists (one slot per particle).
+    # Live particles are always packed into [0, count) so stepping and drawing never
+    # touch dead slots, and killing a particle swaps the last live one into its place.
+    def __init__(self, capacity=POOL_SIZE):
+        self.capacity = capacity
+        self.count = 0
+        self.kind = [0] * capacity
+        self.pos = [0.0] * capacity
+        self.vel = [0.0] * capacity
+        self.life = [0.0] * capacity
+        self.decay = [0.0] * capacity
+        self.size = [0.0] * capacity
+        self.red = [0.0] * capacity
+        self.green = [0.0] * capacity
+        self.blue = [0.0] * capacity
+
+    def spawn(self, kind, pos, vel, rgb, decay, size):
+        i = self.count
+        if i < self.capacity:
+            self.count += 1
+        else:
+            # Pool is full. Recycle whichever particle is closest to dying
+            life = self.life
+            i = 0
+            for j in range(1, self.capacity):
+                if life[j] < life[i]:
+                    i = j
+        self.kind[i] = kind
+        self.pos[i] = pos
+        self.vel[i] = vel
+        self.life[i] = 1.0
+        self.decay[i] = decay
+        self.size[i] = size
+        self.red[i] = rgb[0]
+        self.green[i] = rgb[1]
+        self.blue[i] = rgb[2]
+        return i
+
+    def kill(self, i):
+        last = self.count - 1
+        if i != last:
+            self.kind[i] = self.kind[last]
+            self.pos[i] = self.pos[last]
+            self.vel[i] = self.vel[last]
+            self.life[i] = self.life[last]
+            self.decay[i] = self.decay[last]
+            self.size[i] = self.size[last]
+            self.red[i] = self.red[last]
+            self.green[i] = self.green[last]
+            self.blue[i] = self.blue[last]
+        self.count = last
+
+    def clear(self):
+        self.count = 0
+
+    def step(self, dt, numLeds):
+        # Advance every live particle by dt seconds and drop the ones that faded out
+        # or left the strip
+        pos = self.pos
+        vel = self.vel
+        life = self.life
+        decay = self.decay
+        size = self.size
+        i = 0
+        while i < self.count:
+            newLife = life[i] - decay[i] * dt
+            newPos = pos[i] + vel[i] * dt
+            if newLife <= 0 or newPos < -size[i] or newPos > numLeds + size[i]:
+                self.kill(i)
+                continue
+            life[i] = newLife
+            pos[i] = newPos
+            i += 1
+
+    def rasterize(self, frame, numLeds):
+        # Additively draw every live particle into a flat [r, g, b, r, g, b, ...] frame
+        kind = self.kind
+        pos = self.pos
+        vel = self.vel
+        life = self.life
+        size = self.size
+        red = self.red
+        green = self.green
+        blue = self.blue
+        for i in range(self.count):
+            p = pos[i]
+            s = size[i]
+            l = life[i]
+            if kind[i] == RIPPLE:
+                # Soft ring front: brightest at p, fading to nothing s LEDs away
+                start = int(p - s) + 1
+                end = int(p + s)
+                for led in range(max(start, 0), min(end, numLeds - 1) + 1):
+                    dist = led - p
+                    if dist < 0:
+                        dist = -dist
+                    k = l * (1 - dist / s)
+                    if k > 0:
+                        j = led * 3
+                        frame[j] += red[i] * k
+                        frame[j + 1] += green[i] * k
+                        frame[j + 2] += blue[i] * k
+            elif kind[i] == COMET:
+                # Bright head at p with a tail trailing s LEDs behind it
+                if vel[i] >= 0:
+                    start = int(p - s) + 1
+                    end = int(p)
+                else:
+                    start = int(p) + 1
+                    end = int(p + s)
+                for led in range(max(start, 0), min(end, numLeds - 1) + 1):
+                    dist = led - p
+                    if dist < 0:
+                        dist = -dist
+                    k = l * (1 - dist / s)
+                    if k > 0:
+                        j = led * 3
+                        frame[j] += red[i] * k
+                        frame[j + 1] += green[i] * k
+                        frame[j + 2] += blue[i] * k
+            else:
+                # Sparkle: a single LED that fades out fast
+                led = int(p)
+                if 0 <= led < numLeds:
+                    k = l * l
+                    j = led * 3
+                    frame[j] += red[i] * k
+                    frame[j + 1] += green[i] * k
+                    frame[j + 2] += blue[i] * k
+
+
+class EffectEngine:
+    # Holds the strip framebuffer: a static layer with the colours of the notes
+    # currently lit, and the particle pool drawn on top of it every frame.
+    # noteOn/noteOff are called from the MIDI callback thread and render from the
+    # render thread, so both go through the same lock.
+    def __init__(self, config, capacity=POOL_SIZE):
+        self.config = config
+        self.numLeds = config.numLeds
+        self.pool = ParticlePool(capacity)
+        self.base = [0.0] * (self.numLeds * 3)
+        self.frame = [0.0] * (self.numLeds * 3)
+        self.pixels = [0] * (self.numLeds * 3)
+        self.beatTime = None
+        self.beatLength = 0.5
+        self.beatCount = 0
+        self.lock = threading.Lock()
+
+    def noteOn(self, led, rgb, velocity):
+        if not 0 <= led < self.numLeds:
+            return
+        # Velocity from 0..1 drives speed and particle count regardless of the velocity toggle
+        strength = 0.25 + 0.75 * (velocity / 127)
+        with self.lock:
+            j = led * 3
+            self.base[j] = rgb[0]
+            self.base[j + 1] = rgb[1]
+            self.base[j + 2] = rgb[2]
+            effect = self.config.effect
+            if effect == 'ripple':
+                speed = RIPPLE_SPEED * strength
+                self.pool.spawn(RIPPLE, led, speed, rgb, 0.8, RIPPLE_WIDTH)
+                self.pool.spawn(RIPPLE, led, -speed, rgb, 0.8, RIPPLE_WIDTH)
+            elif effect == 'comet':
+                speed = COMET_SPEED * strength
+                # Comets fly away from the nearer end of the strip
+                if led < self.numLeds / 2:
+                    self.pool.spawn(COMET, led, speed, rgb, 0.6, COMET_TAIL * strength)
+                else:
+                    self.pool.spawn(COMET, led, -speed, rgb, 0.6, COMET_TAIL * strength)
+            elif effect == 'sparkle':
+                for i in range(1 + int(MAX_SPARKLES * velocity / 127)):
+                    pos = led + random.randint(-SPARKLE_SPREAD, SPARKLE_SPREAD)
+                    self.pool.spawn(SPARKLE, pos, 0.0, rgb, 1.5 + random.random() * 2, 1.0)
+
+    def noteOff(self, led):
+        if not 0 <= led < self.numLeds:
+            return
+        with self.lock:
+            j = led * 3
+            self.base[j] = 0.0
+            self.base[j + 1] = 0.0
+            self.base[j + 2] = 0.0
+
+    def clear(self):
+        with self.lock:
+            self.pool.clear()
+            for i in range(len(self.base)):
+                self.base[i] = 0.0
+
+    def beat(self, time, length, count):
+        # Called by the tempo clock on every beat with the exact time the beat fell on
+        with self.lock:
+            self.beatTime = time
+            self.beatLength = length
+            self.beatCount = count
+
+    def drawBeat(self, frame, now):
+        # Whole-strip beat layer, drawn from how far into the beat we are
+        effect = self.config.beatEffect
+        if effect == 'none' or self.beatTime is None:
+            return
+        since = now - self.beatTime
+        if since < 0:
+            return
+        phase = since / self.beatLength
+        rgb = self.config.RGB
+        if effect == 'pulse':
+            k = PULSE_LEVEL * (1 - phase * 2)
+        elif effect == 'strobe':
+            k = 1.0 if since < STROBE_TIME else 0.0
+        else:
+            # Fade from one colour to the other over each beat, swapping direction every beat
+            start, end = (self.config.RGB, self.config.RGB2) if self.beatCount % 2 == 0 else (self.config.RGB2, self.config.RGB)
+            mix = min(phase, 1.0)
+            rgb = [start[i] + (end[i] - start[i]) * mix for i in range(3)]
+            k = CYCLE_LEVEL
+        if k <= 0:
+            return
+        r = rgb[0] * k
+        g = rgb[1] * k
+        b = rgb[2] * k
+        for j in range(0, len(frame), 3):
+            frame[j] += r
+            frame[j + 1] += g
+            frame[j + 2] += b
+
+    def render(self, dt, now=None):
+        # Advance the particles by dt seconds and return the clamped [r, g, b, ...] pixels.
+        # now is the render time on the tempo clock's timeline, needed for the beat layer.
+        # The returned list is reused between frames
+        frame = self.frame
+        pixels = self.pixels
+        with self.lock:
+            self.pool.step(dt, self.numLeds)
+            frame[:] = self.base
+            if now is not None:
+                self.drawBeat(frame, now)
+            self.pool.rasterize(frame, self.numLeds)
+        for i in range(len(frame)):
+            v = int(frame[i])
+            pixels[i] = 255 if v > 255 else v
+        return pixels
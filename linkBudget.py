@@ -0,0 +1,132 @@
+"""Frame rate and encoding control to keep serial output within the link's byte budget."""
+
+# Serial is 8N1: a start and stop bit for every data byte
+BITS_PER_BYTE = 10
+# Fraction of the link we let ourselves use
+HEADROOM = 0.8
+MIN_FPS = 10
+MAX_FPS = 60
+# Writes shorter than this only filled the OS buffer and say nothing about the link speed
+MIN_TIMED_WRITE = 0.001
+# Smoothing for the moving averages
+SMOOTHING = 0.2
+
+FULL_PREFIX = b'{"seg":{"i":["'
+FULL_SUFFIX = b'"]}}'
+DIFF_PREFIX = b'{"seg":{"i":['
+DIFF_SUFFIX = b']}}'
+
+
+def encodeFull(pixels):
+    # Whole strip: WLED takes consecutive hex colours starting at LED 0
+    colors = ['%02x%02x%02x' % (pixels[i], pixels[i+1], pixels[i+2]) for i in range(0, len(pixels), 3)]
+    return FULL_PREFIX + '","'.join(colors).encode('ascii') + FULL_SUFFIX
+
+def encodeDiff(pixels, changed):
+    # Only the changed LEDs as index, colour pairs
+    parts = ['%d,"%02x%02x%02x"' % (led, pixels[led*3], pixels[led*3+1], pixels[led*3+2]) for led in changed]
+    return DIFF_PREFIX + ','.join(parts).encode('ascii') + DIFF_SUFFIX
+
+
+class LinkBudget:
+    # Decides each tick whether to send a frame, how to encode it and how long to wait
+    # until the next one. Frames that don't fit the budget are dropped without touching
+    # the copy of what was last sent, so their changes are merged into the next frame.
+    def __init__(self, baud, numLeds):
+        self.numLeds = numLeds
+        self.lineRate = baud / BITS_PER_BYTE
+        self.measuredRate = None
+        self.sent = [-1] * (numLeds * 3)
+        self.changed = []
+        self.tokens = 0.0
+        self.lastTick = None
+        self.avgPayload = float(len(FULL_PREFIX) + len(FULL_SUFFIX) + numLeds * 9)
+        self.fps = MAX_FPS
+        self.metrics = {
+            'budget': 0,
+            'measuredRate': 0,
+            'fps': MAX_FPS,
+            'encoding': None,
+            'framesSent': 0,
+            'framesDropped': 0,
+            'fullFrames': 0,
+            'diffFrames': 0,
+            'bytesSent': 0,
+        }
+
+    def budget(self):
+        # Bytes per second we allow ourselves
+        rate = self.lineRate
+        if self.measuredRate is not None and self.measuredRate < rate:
+            rate = self.measuredRate
+        return rate * HEADROOM
+
+    def interval(self):
+        return 1 / self.fps
+
+    def nextPayload(self, pixels, now):
+        # Return the bytes to write for this tick, or None if nothing should be sent
+        budget = self.budget()
+        if self.lastTick is not None:
+            self.tokens = min(self.tokens + budget * (now - self.lastTick), budget)
+        self.lastTick = now
+        self.metrics['budget'] = int(budget)
+
+        sent = self.sent
+        changed = self.changed
+        changed.clear()
+        for led in range(self.numLeds):
+            j = led * 3
+            if pixels[j] != sent[j] or pixels[j+1] != sent[j+1] or pixels[j+2] != sent[j+2]:
+                changed.append(led)
+        if not changed:
+            return None
+        if self.tokens < 0:
+            # Still paying off the last frame. Drop this one, its changes go out with the next
+            self.metrics['framesDropped'] += 1
+            return None
+
+        # Pick whichever encoding is smaller. A diff entry is the index, a comma and a quoted colour
+        fullSize = len(FULL_PREFIX) + len(FULL_SUFFIX) + self.numLeds * 9
+        diffSize = len(DIFF_PREFIX) + len(DIFF_SUFFIX)
+        for led in changed:
+            diffSize += len(str(led)) + 10
+        if diffSize < fullSize:
+            payload = encodeDiff(pixels, changed)
+            self.metrics['encoding'] = 'diff'
+            self.metrics['diffFrames'] += 1
+        else:
+            payload = encodeFull(pixels)
+            self.metrics['encoding'] = 'full'
+            self.metrics['fullFrames'] += 1
+        sent[:] = pixels
+        self.tokens -= len(payload)
+
+        # Frame rate follows how big frames have been lately
+        self.avgPayload += SMOOTHING * (len(payload) - self.avgPayload)
+        self.fps = max(MIN_FPS, min(MAX_FPS, budget / self.avgPayload))
+        self.metrics['fps'] = round(self.fps, 1)
+        return payload
+
+    def recordWrite(self, size, duration):
+        # Called after every write to learn what the link actually takes
+        self.metrics['framesSent'] += 1
+        self.metrics['bytesSent'] += size
+        if duration >= MIN_TIMED_WRITE:
+            rate = size / duration
+        else:
+            # Too quick to time, but the link took at least this much. Only ever used to
+            # raise the estimate, so one slow write doesn't hold the budget down for good
+            rate = size / MIN_TIMED_WRITE
+            if self.measuredRate is None or rate <= self.measuredRate:
+                return
+        if self.measuredRate is None:
+            self.measuredRate = rate
+        else:
+            self.measuredRate += SMOOTHING * (rate - self.measuredRate)
+        self.metrics['measuredRate'] = int(self.measuredRate)
+
+    def reset(self):
+        # Forget what the strip shows, e.g. after the port was reopened
+        for i in range(len(self.sent)):
+            self.sent[i] = -1
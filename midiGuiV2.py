@@ -19,6 +19,10 @@ from nicegui import ui
 from rtmidi.midiutil import open_midiinput
 import rtmidi
 import midiToWLED
+import midiInputs
+import netIngest
+import profiler
+import ledEffects
 
 # Color Conversion Methods
 def rgb_to_hex(rgb):
@@ -46,14 +50,24 @@ class Config:
         self.sustain = True
         self.velocity = False
         self.alternating = False
+        self.effect = "none"
+        self.midiPorts = []
+        self.beatEffect = "none"
+        self.bpm = 120
+        self.network = False
+        self.netListen = "0.0.0.0"
+        self.oscPort = 9000
+        self.netMidiPort = 5004
+        self.rawMidiPort = 5006
+        self.profile = False
 
 config = Config()
 
 try:
     with open(pathlib.Path("~/Documents/LEDController/config.json").expanduser().resolve(), "r") as jsonfile:
         configVals = json.load(jsonfile)
-        for index, val in configVals:
-            config.index = val
+        for index, val in configVals.items():
+            setattr(config, index, val)
         print("Read successful.\n")
 except:
     print("Read fail. Config file does not exist. File will be written upon exit")
@@ -76,9 +90,6 @@ ser.port = config.comPort
 ser.timeout = 10
 ser.bytesize=8
 
-# Define Midi Connection
-midiin = None
-
 # # Define midi config function
 # def getNewMidiValue():
 #     if midiPortConfig is None:
@@ -97,9 +108,6 @@ midiin = None
 # Define baud rate options
 baudOptions = [115200, 230400, 460800, 500000, 576000, 921600, 1000000, 1500000]
 
-# Define modes options
-modes = ['solid', 'alternating', 'gradient', 'rainbowGradient']
-
 # Define data
 data = {
     'config': config,
@@ -108,8 +116,23 @@ data = {
     'heldNotes': {},
     'timer': timer,
     'serial': ser,
+    'effects': None,
+    'link': None,
+    'rendering': False,
+    'renderThread': None,
+    'midi': None,
+    'scheduler': None,
+    'tempo': None,
+    'net': None,
+    'onRenderError': None,
 }
 
+# Define Midi Connection
+midiin = midiInputs.MidiMerger(midiToWLED.handleMidiInput, data)
+
+# Define Profiler
+prof = profiler.Profiler()
+
 # Define running
 class Running:
     def __init__(self):
@@ -125,27 +148,82 @@ def runScript():
         # Stop
         running.running = False
         running.buttonText='RUN'
+        prof.disable()
+        midiToWLED.stopRenderer(data)
         exitData = {"state":{"on": False}}
         exitData = json.dumps(exitData)
-        ser.write(exitData.encode('ascii'))
+        try:
+            ser.write(exitData.encode('ascii'))
+        except Exception as e:
+            print("Serial write fail: " + str(e))
         ser.close()
-        midiin.close_port()
+        data['midi'] = None
+        if data['net'] is not None:
+            data['net'].stop()
+            data['net'] = None
+        midiin.close()
         print("CLOSED!")
     else:
         if(running.runnable):
+            try:
+                ser.open()
+                # Save state and set brightness
+                initData = {"state":{"on": True, "bri": 255}}
+                initData = json.dumps(initData)
+                ser.write(initData.encode('ascii'))
+                midiToWLED.startRenderer(data)
+                # Primary port takes every channel, extra ports are routed by their config entry.
+                # A port can only be opened once, so the primary one is never an extra
+                midiin.open([{'device': config.midiDevice}] + [route for route in config.midiPorts if route['device'] != config.midiDevice])
+                data['midi'] = midiin
+            except Exception as e:
+                # Undo whatever did start so we're back to stopped
+                print("Start fail: " + str(e))
+                midiToWLED.stopRenderer(data)
+                data['midi'] = None
+                midiin.close()
+                ser.close()
+                return
             running.running = True
-            ser.open()
-            # Save state and set brightness
-            initData = {"state":{"on": True, "bri": 255}}
-            initData = json.dumps(initData)
-            ser.write(initData.encode('ascii'))
-            midiin, portname = rtmidi.midiutil.open_midiinput(config.midiDevice)
-            midiin.set_callback(midiToWLED.handleMidiInput, data=data)
+            if config.network:
+                # OSC and network MIDI from the FOH computer. Keep running on USB if it can't start
+                net = netIngest.NetIngest(data, midiin)
+                try:
+                    net.start()
+                    data['net'] = net
+                except Exception as e:
+                    print("Network input fail: " + str(e))
+            if config.profile:
+                prof.enable(data)
             running.buttonText='STOP'
             print("RUNNING!")
         else:
             print("Error.")
 
+def renderFailed():
+    # The render thread gave up, e.g. the LED board was unplugged. Stop so the GUI shows it
+    if running.running:
+        runScript()
+
+data['onRenderError'] = renderFailed
+
+def setProfiling(value):
+    # Profiling hooks into the running pipeline, so it only starts once running
+    if running.running:
+        if value:
+            prof.enable(data)
+        else:
+            prof.disable()
+
+def dumpProfile():
+    try:
+        filepath = pathlib.Path("~/Documents/LEDController/").expanduser().resolve()
+        filepath.mkdir(parents=True, exist_ok=True)
+        prof.dump(filepath.joinpath("./profile.collapsed"))
+        print("Profile written to " + str(filepath.joinpath("./profile.collapsed")))
+    except Exception as e:
+        print("Profile write fail: " + str(e))
+
 def checkRunnable():
     running.runnable = config.baud is not None and config.midiDevice is not None and config.comPort is not None
 
@@ -154,6 +232,17 @@ def getMidiPort(val):
         return None
     else:
         return trimmedPorts.index(val)
+
+def getMidiPorts(vals):
+    # Keep the channel/zone routing of ports that were already configured
+    routes = {route['device']: route for route in config.midiPorts}
+    ports = []
+    for val in vals or []:
+        device = trimmedPorts.index(val)
+        if device == config.midiDevice:
+            continue
+        ports.append(routes.get(device, {'device': device}))
+    return ports
     
 # GUI AND RUN
 # First UI Row: Device Config (Serial, Midi, Baud)
@@ -161,6 +250,9 @@ with ui.row():
     with ui.column():
         ui.label('MIDI PORT')
         ui.select(trimmedPorts, on_change=checkRunnable).bind_value_to(config, 'midiDevice', forward=getMidiPort).bind_enabled_from(running, 'running', backward=lambda x: not x)
+    with ui.column():
+        ui.label('EXTRA MIDI PORTS')
+        ui.select(trimmedPorts, multiple=True, value=[trimmedPorts[route['device']] for route in config.midiPorts if route['device'] < len(trimmedPorts)]).bind_value_to(config, 'midiPorts', forward=getMidiPorts).bind_enabled_from(running, 'running', backward=lambda x: not x)
     with ui.column():
         ui.label('LED PORT')
         ui.select(ports, on_change=checkRunnable).bind_value_to(config, 'comPort').bind_value_to(ser, 'port').bind_enabled_from(running, 'running', backward=lambda x: not x)
@@ -171,13 +263,35 @@ with ui.row():
 with ui.row():
     ui.color_input(label='RGB1', value=rgb_to_hex(config.RGB)).bind_value(config, 'RGB', forward=lambda x: hex_to_rgb(x), backward=lambda x: rgb_to_hex(x))
     ui.color_input(label='RGB2', value=rgb_to_hex(config.RGB2)).bind_value(config, 'RGB2', forward=lambda x: hex_to_rgb(x), backward=lambda x: rgb_to_hex(x))
-    ui.select(modes).bind_value(config, 'mode')
+    ui.select(midiToWLED.modes).bind_value(config, 'mode')
+    ui.select(ledEffects.effects).bind_value(config, 'effect')
 # Third UI Row: Sustain & Velocity
 with ui.row():
     ui.switch("Sustain").bind_value(config, 'sustain')
     ui.switch("Velocity").bind_value(config, 'velocity')
+# Fourth UI Row: Beat effect, free running tempo & network input
+with ui.row():
+    ui.select(ledEffects.beatEffects, label='Beat Effect').bind_value(config, 'beatEffect')
+    ui.number(label='BPM', min=25, max=300).bind_value(config, 'bpm')
+    ui.switch("Network").bind_value(config, 'network').bind_enabled_from(running, 'running', backward=lambda x: not x)
+# Fifth UI Row: Profiling
+with ui.row():
+    ui.switch("Profile", on_change=lambda e: setProfiling(e.value)).bind_value(config, 'profile')
+    ui.button("Dump Profile", on_click=dumpProfile)
+    ui.button("Reset Profile", on_click=prof.reset)
 # Button
 runButton = ui.button("Run", on_click=runScript).bind_text_from(running, 'buttonText').bind_enabled_from(running, 'runnable')
+# Link, MIDI port and tempo metrics
+linkLabel = ui.label('')
+midiLabel = ui.label('')
+tempoLabel = ui.label('')
+netLabel = ui.label('')
+profileLabel = ui.label('')
+ui.timer(1.0, lambda: linkLabel.set_text(midiToWLED.linkSummary(data)))
+ui.timer(1.0, lambda: midiLabel.set_text(midiin.summary()))
+ui.timer(1.0, lambda: tempoLabel.set_text(midiToWLED.tempoSummary(data)))
+ui.timer(1.0, lambda: netLabel.set_text(data['net'].summary() if data['net'] is not None else ''))
+ui.timer(1.0, lambda: profileLabel.set_text(prof.summary()))
 
 ui.run()
 
@@ -0,0 +1,171 @@
+"""Read several MIDI input ports at once and merge them into one timestamp-ordered stream."""
+
+import collections
+import heapq
+import itertools
+import logging
+import time
+
+from rtmidi.midiutil import open_midiinput
+
+# How long to hold events back so a slightly later event from another port can still be put in order
+MERGE_WINDOW = 0.002
+# A port clock this far behind arrival time has drifted and is re-anchored
+MAX_DRIFT = 0.05
+
+log = logging.getLogger('midiin_poll')
+
+
+class MidiPort:
+    # One open input port. The rtmidi callback only timestamps the message and appends it
+    # to this port's queue; routing happens on the merging side.
+    def __init__(self, route, counter):
+        self.route = route
+        self.device = route['device']
+        self.channels = route.get('channels')
+        self.zone = route.get('zone')
+        self.transpose = route.get('transpose', 0)
+        self.counter = counter
+        self.queue = collections.deque()
+        self.midiin = None
+        self.name = None
+        self.clock = None
+        self.events = 0
+        self.dropped = 0
+        self.errors = 0
+        self.rate = 0.0
+        self.lastCount = 0
+
+    def open(self):
+        self.midiin, self.name = open_midiinput(self.device)
+        # Let MIDI clock through for the tempo clock
+        self.midiin.ignore_types(sysex=True, timing=False, active_sense=True)
+        self.clock = None
+        self.midiin.set_callback(self.onMessage)
+
+    def close(self):
+        if self.midiin is not None:
+            self.midiin.close_port()
+            self.midiin = None
+
+    def onMessage(self, msg, data=None):
+        message, deltatime = msg
+        arrival = time.perf_counter()
+        # Port time is the sum of rtmidi's deltas since the first message, on the perf_counter clock.
+        # rtmidi gives the first message a delta of 0, so that one is anchored at its arrival
+        if self.clock is None:
+            stamp = arrival
+        else:
+            stamp = self.clock + deltatime
+        if stamp > arrival or stamp < arrival - MAX_DRIFT:
+            stamp = arrival
+        self.clock = stamp
+        self.push(message, stamp)
+
+    def push(self, message, stamp):
+        # Queue a message with its perf_counter timestamp. Safe from any thread
+        self.queue.append((stamp, next(self.counter), self, message))
+
+    def accept(self, message, held):
+        # Apply this port's channel and zone routing. Channel messages are moved to channel 1
+        # so the note state sees one keyboard. Returns False if the message should be dropped
+        status = message[0]
+        if status >= 0xF0:
+            return True
+        if self.channels is not None and (status & 0x0F) + 1 not in self.channels:
+            return False
+        message[0] = status & 0xF0
+        if message[0] in (0x80, 0x90) and len(message) > 1:
+            note = message[1] + self.transpose
+            if self.zone is not None and not self.zone[0] <= note <= self.zone[1]:
+                return False
+            if not 0 <= note <= 127:
+                return False
+            message[1] = note
+            if message[0] == 0x80:
+                # The note state toggles on note on, so a release is a note on with velocity 0
+                # like the keyboard sends. A release for a note that isn't held would light it
+                if note not in held:
+                    return False
+                message[0] = 0x90
+                message[2:] = [0]
+        return True
+
+
+class MidiMerger:
+    # Owns every open port and hands their messages to handler(msg, data) in timestamp order.
+    # drain() is called from the render loop so note state is only ever touched by one thread
+    def __init__(self, handler, data):
+        self.handler = handler
+        self.data = data
+        self.ports = []
+        self.counter = itertools.count()
+        self.lastStamp = None
+        self.lastRateUpdate = None
+        self.ready = []
+
+    def open(self, routes):
+        for route in routes:
+            port = MidiPort(route, self.counter)
+            port.open()
+            self.ports.append(port)
+
+    def addPort(self, port):
+        # Merge a port that is fed some other way, e.g. from the network
+        self.ports.append(port)
+
+    def removePort(self, port):
+        if port in self.ports:
+            self.ports.remove(port)
+
+    def close(self):
+        for port in self.ports:
+            port.close()
+        self.ports = []
+        self.lastStamp = None
+
+    def drain(self, now):
+        # Dispatch everything that arrived before now - MERGE_WINDOW
+        horizon = now - MERGE_WINDOW
+        ready = self.ready
+        ready.clear()
+        for port in self.ports:
+            queue = port.queue
+            events = []
+            while queue and queue[0][0] <= horizon:
+                events.append(queue.popleft())
+            if events:
+                ready.append(events)
+        if ready:
+            # Every port queue is already in order, so a heap merge gives the global order
+            for stamp, seq, port, message in heapq.merge(*ready):
+                port.events += 1
+                if not port.accept(message, self.data['heldNotes']):
+                    port.dropped += 1
+                    continue
+                delta = 0.0 if self.lastStamp is None else stamp - self.lastStamp
+                self.lastStamp = stamp
+                try:
+                    self.handler((message, delta), self.data)
+                except Exception:
+                    # The rest of the batch is already off the queues. Count a bad message
+                    # against its port and carry on rather than losing them
+                    port.errors += 1
+                    log.exception("MIDI handler error on %s: %r", port.name, message)
+        self.updateRates(now)
+
+    def updateRates(self, now):
+        if self.lastRateUpdate is None:
+            self.lastRateUpdate = now
+            return
+        elapsed = now - self.lastRateUpdate
+        if elapsed < 1.0:
+            return
+        for port in self.ports:
+            port.rate = (port.events - port.lastCount) / elapsed
+            port.lastCount = port.events
+        self.lastRateUpdate = now
+
+    def summary(self):
+        # One line of per-port event counters for the GUI
+        return " | ".join("%s: %.0f/s (%d, dropped %d, errors %d)" % (port.name, port.rate, port.events, port.dropped, port.errors) for port in self.ports)
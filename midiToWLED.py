@@ -17,6 +17,9 @@ import PySimpleGUI as sg
 import colorsys
 
 from rtmidi.midiutil import open_midiinput
+import ledEffects
+import linkBudget
+import tempoClock
 del pywizlight.wizlight.__del__
 
 
@@ -24,6 +27,12 @@ del pywizlight.wizlight.__del__
 log = logging.getLogger('midiin_poll')
 logging.basicConfig(level=logging.DEBUG)
 
+# Failed frames in a row before the render thread gives up
+MAX_RENDER_ERRORS = 10
+
+# Colour modes
+modes = ['solid', 'alternating', 'gradient', 'rainbowGradient']
+
 # Functions
 def mapRange(value, inMin, inMax, outMin, outMax):
     return outMin + (((value - inMin) / (inMax - inMin)) * (outMax - outMin))
@@ -78,9 +87,13 @@ def getRGBValue(config, velocity, pos):
         return getVelocityAwareRGB( rgbVal, velocity )
     
 
-def sendNoteOn(ser, note, velocity, config):
+def sendNoteOn(ser, note, velocity, config, effects=None):
     if ((note >= config.midiStart) and (note <= config.midiEnd)) or ((note >= config.midiEnd) and (note <= config.midiStart)):
         led = getLed(config, note)
+        if effects is not None:
+            # The render thread owns the serial port, just update the framebuffer
+            effects.noteOn(led-1, getRGBValue(config, velocity, led), velocity)
+            return
         data = {"seg":{"i":[led-1, getRGBValue(config, velocity, led), config.numLeds-led]}}
         data = json.dumps(data)
         ser.write(data.encode('ascii'))
@@ -91,9 +104,12 @@ def sendNoteOn(ser, note, velocity, config):
 
 
 
-def sendNoteOff(ser, note, config):
+def sendNoteOff(ser, note, config, effects=None):
     if ((note >= config.midiStart) and (note <= config.midiEnd)) or ((note >= config.midiEnd) and (note <= config.midiStart)):
         led = getLed(config, note)
+        if effects is not None:
+            effects.noteOff(led-1)
+            return
         data = {"seg":{"i":[led-1, [0,0,0], config.numLeds-led]}}
         data = json.dumps(data)
         ser.write(data.encode('ascii'))
@@ -102,6 +118,85 @@ def sendNoteOff(ser, note, config):
     else:
         print("Value out of range: " + str(note))
 
+def renderLoop(data):
+    # Runs on its own thread while running: step the effects and send whatever the link budget allows
+    effects = data['effects']
+    link = data['link']
+    scheduler = data['scheduler']
+    ser = data['serial']
+    last = time.perf_counter()
+    errors = 0
+    while data['rendering']:
+        now = time.perf_counter()
+        try:
+            # Apply network config changes and hand the merged MIDI input to the note state,
+            # then fire due beats before drawing
+            if data.get('net') is not None:
+                data['net'].drain()
+            if data.get('midi') is not None:
+                data['midi'].drain(now)
+            scheduler.advance(now)
+            pixels = effects.render(now - last, now)
+            last = now
+            payload = link.nextPayload(pixels, now)
+            if payload is not None:
+                writeStart = time.perf_counter()
+                ser.write(payload)
+                link.recordWrite(len(payload), time.perf_counter() - writeStart)
+            errors = 0
+        except Exception:
+            # Keep going through the odd bad frame, but a dead serial port fails every frame
+            errors += 1
+            log.exception("Render loop error")
+            # Whatever was being sent may not have arrived, send the whole strip again
+            link.reset()
+            if errors >= MAX_RENDER_ERRORS:
+                log.error("Render loop stopped after %d errors in a row", errors)
+                data['rendering'] = False
+                if data.get('onRenderError') is not None:
+                    data['onRenderError']()
+                return
+        remaining = link.interval() - (time.perf_counter() - now)
+        # Wake up for the next beat rather than up to a frame after it. The wheel fires on the
+        # tick after the deadline, so wait for that or we'd spin until it comes round
+        beatTimer = data['tempo'].beatTimer
+        if beatTimer is not None:
+            remaining = min(remaining, beatTimer.tick * tempoClock.RESOLUTION - time.perf_counter())
+        if remaining > 0:
+            time.sleep(remaining)
+
+def startRenderer(data):
+    # Notes are drawn into a framebuffer and the render thread sends it out, merging bursts of notes into frames
+    config = data['config']
+    data['effects'] = ledEffects.EffectEngine(config)
+    data['link'] = linkBudget.LinkBudget(config.baud, config.numLeds)
+    data['scheduler'] = tempoClock.TimerWheel()
+    data['tempo'] = tempoClock.TempoClock(data['scheduler'], data['effects'].beat, config)
+    data['tempo'].start(time.perf_counter())
+    data['rendering'] = True
+    data['renderThread'] = threading.Thread(target=renderLoop, args=(data,), daemon=True)
+    data['renderThread'].start()
+
+def stopRenderer(data):
+    if data.get('renderThread') is not None:
+        data['rendering'] = False
+        # The render thread stops itself on errors and can end up here
+        if data['renderThread'] is not threading.current_thread():
+            data['renderThread'].join()
+        data['renderThread'] = None
+    data['effects'] = None
+    data['link'] = None
+    data['scheduler'] = None
+    data['tempo'] = None
+
+def linkSummary(data):
+    # One line of link metrics for the GUI
+    if data.get('link') is None:
+        return ''
+    m = data['link'].metrics
+    return "%s fps | %s B/s budget | %s B/s measured | %s | sent %d (full %d, diff %d) | dropped %d" % (
+        m['fps'], m['budget'], m['measuredRate'], m['encoding'], m['framesSent'], m['fullFrames'], m['diffFrames'], m['framesDropped'])
+
 # async def updateLight(light, rgbVal, brightness):
 #     if(rgbVal == [0,0,0]):
 #         await light.turn_off()
@@ -159,10 +254,26 @@ def sendNoteOff(ser, note, config):
 #     future.result()
 #     return loop
 
+def tempoSummary(data):
+    if data.get('tempo') is None:
+        return ''
+    return data['tempo'].summary()
+
+def eventTime(data):
+    # perf_counter time of the message being handled. The port merger knows it exactly
+    if data.get('midi') is not None and data['midi'].lastStamp is not None:
+        return data['midi'].lastStamp
+    return time.perf_counter()
+
 def handleMidiInput(msg, data=None):
     if msg:
         message, deltatime = msg
         data['timer'] += deltatime
+        # System messages: clock, start/stop/continue, song position
+        if message[0] >= 0xF0:
+            if data.get('tempo') is not None:
+                data['tempo'].onMessage(message, eventTime(data))
+            return
         print("[%s] @%0.6f %r" % ("MIDI", data['timer'], message))
         # Check if this is a noteOn Message
         if(message[0] == 144):
@@ -172,11 +283,11 @@ def handleMidiInput(msg, data=None):
                 if message[1] in data['heldNotes']:
                     # Is currently held. Send an off message and remove from heldNotes
                     data['heldNotes'].pop(message[1])
-                    sendNoteOff(data['serial'], message[1], data['config'])
+                    sendNoteOff(data['serial'], message[1], data['config'], data.get('effects'))
                 else:
                     # Not being held. Add and send
                     data['heldNotes'][message[1]] = 127
-                    sendNoteOn(data['serial'], message[1], message[2], data['config'])
+                    sendNoteOn(data['serial'], message[1], message[2], data['config'], data.get('effects'))
             else:
                 # Sustaining. If holding, then we are releasing and should remove from heldNotes but keep in sustainedNotes. Don't send serial.
                 if message[1] in data['heldNotes']:
@@ -187,12 +298,12 @@ def handleMidiInput(msg, data=None):
                     data['heldNotes'][message[1]] = message[2]
                     # However, update velocity // NEW
                     data['sustainedNotes'][message[1]] = message[2]
-                    sendNoteOn(data['serial'], message[1], message[2], data['config'])
+                    sendNoteOn(data['serial'], message[1], message[2], data['config'], data.get('effects'))
                 else:    
                     # Not holding. Add to held notes and sustained. Send serial.
                     data['heldNotes'][message[1]] = message[2]
                     data['sustainedNotes'][message[1]] = message[2]
-                    sendNoteOn(data['serial'], message[1], message[2], data['config'])
+                    sendNoteOn(data['serial'], message[1], message[2], data['config'], data.get('effects'))
         elif(data['config'].sustain and message[0] == 176 and message[1] == 64):
             # Damper Pedal Control.. invert sustain and handle
             if(data['sustain']):
@@ -201,7 +312,7 @@ def handleMidiInput(msg, data=None):
                 for index, velocity in data['sustainedNotes'].items():
                     if not index in data['heldNotes']:
                         # The note isn't being held. Send a message to turn off light
-                        sendNoteOff(data['serial'], index, data['config'])
+                        sendNoteOff(data['serial'], index, data['config'], data.get('effects'))
                 data['sustainedNotes'] = {}
             else:
                 data['sustain'] = True
@@ -0,0 +1,428 @@
+"""Network control input: OSC and RTP-MIDI style MIDI over UDP."""
+
+import asyncio
+import collections
+import json
+import random
+import struct
+import threading
+import time
+
+import ledEffects
+import midiInputs
+import midiToWLED
+
+# Precompiled so parsing doesn't build format objects per message
+INT32 = struct.Struct('>i')
+UINT32 = struct.Struct('>I')
+INT64 = struct.Struct('>q')
+FLOAT32 = struct.Struct('>f')
+FLOAT64 = struct.Struct('>d')
+RTP_HEADER = struct.Struct('>BBHII')
+APPLE_MIDI = struct.Struct('>H2sIII')
+APPLE_CLOCK = struct.Struct('>H2sIB3xQQQ')
+
+OSC_BUNDLE = b'#bundle\0'
+# Bundles inside bundles deeper than this are dropped
+MAX_BUNDLE_DEPTH = 8
+SESSION_NAME = b'midi-led-controller\0'
+# AppleMIDI sessions run the RTP clock at 10 kHz, which is what MIDI list delta times count
+RTP_CLOCK_RATE = 10000
+
+# Data bytes following each status byte (system exclusive is skipped separately)
+def dataLength(status):
+    if status < 0xC0 or 0xE0 <= status < 0xF0:
+        return 2
+    if status < 0xE0:
+        return 1
+    if status == 0xF2:
+        return 2
+    if status in (0xF1, 0xF3):
+        return 1
+    return 0
+
+
+class NetPort(midiInputs.MidiPort):
+    # A merger port fed from the network thread instead of an rtmidi callback
+    def __init__(self, name, counter, route=None):
+        midiInputs.MidiPort.__init__(self, route or {'device': None}, counter)
+        self.name = name
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class OscProtocol(asyncio.DatagramProtocol):
+    def __init__(self, ingest):
+        self.ingest = ingest
+
+    def datagram_received(self, packet, addr):
+        self.ingest.parseOsc(packet, 0, len(packet), time.perf_counter())
+
+
+class NetMidiProtocol(asyncio.DatagramProtocol):
+    # raw is for the port that takes bare MIDI bytes instead of AppleMIDI/RTP packets
+    def __init__(self, ingest, raw=False):
+        self.ingest = ingest
+        self.raw = raw
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, packet, addr):
+        self.ingest.parseNetMidi(packet, addr, self.transport, self.raw, time.perf_counter())
+
+
+class NetIngest:
+    # Listens for OSC and network MIDI on its own asyncio loop thread. Notes and other MIDI go into
+    # NetPorts on the MIDI merger so they reach handleMidiInput in order with the local ports.
+    # Config changes are queued and applied once per frame by drain(), last value wins
+    def __init__(self, data, merger):
+        self.data = data
+        self.config = data['config']
+        self.merger = merger
+        self.oscPort = NetPort('osc', merger.counter)
+        self.midiPort = NetPort('net midi', merger.counter)
+        merger.addPort(self.oscPort)
+        merger.addPort(self.midiPort)
+        self.changes = collections.deque()
+        self.batch = {}
+        self.args = []
+        self.commands = []
+        self.ssrc = random.getrandbits(32)
+        self.loop = None
+        self.thread = None
+        self.transports = []
+        self.packets = 0
+        self.errors = 0
+        self.oscHandlers = [
+            (b'/note/on\0', self.oscNoteOn),
+            (b'/note/off\0', self.oscNoteOff),
+            (b'/midi\0', self.oscMidi),
+            (b'/mode\0', self.oscMode),
+            (b'/effect\0', self.oscEffect),
+            (b'/beat\0', self.oscBeat),
+            (b'/color\0', self.oscColor),
+            (b'/color1\0', self.oscColor),
+            (b'/color2\0', self.oscColor2),
+            (b'/brightness\0', self.oscBrightness),
+            (b'/bpm\0', self.oscBpm),
+        ]
+
+    # Lifecycle
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        try:
+            asyncio.run_coroutine_threadsafe(self.listen(), self.loop).result()
+        except Exception:
+            # Port in use, out of range or not a number, or a bad listen address. Undo
+            # everything before passing it on
+            self.stop()
+            raise
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    async def listen(self):
+        host = self.config.netListen
+        transport, protocol = await self.loop.create_datagram_endpoint(lambda: OscProtocol(self), local_addr=(host, self.config.oscPort))
+        self.transports.append(transport)
+        # The network MIDI port is the AppleMIDI control port, data comes in on the one after
+        for port in (self.config.netMidiPort, self.config.netMidiPort + 1):
+            transport, protocol = await self.loop.create_datagram_endpoint(lambda: NetMidiProtocol(self), local_addr=(host, port))
+            self.transports.append(transport)
+        # Bare MIDI bytes, handy for testing with a plain UDP sender
+        transport, protocol = await self.loop.create_datagram_endpoint(lambda: NetMidiProtocol(self, raw=True), local_addr=(host, self.config.rawMidiPort))
+        self.transports.append(transport)
+
+    def stop(self):
+        if self.loop is None:
+            return
+        for transport in self.transports:
+            self.loop.call_soon_threadsafe(transport.close)
+        self.transports = []
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.loop = None
+        self.merger.removePort(self.oscPort)
+        self.merger.removePort(self.midiPort)
+
+    # Per frame
+    def drain(self):
+        # Apply the config changes that came in since the last frame. Called from the render loop
+        changes = self.changes
+        if not changes:
+            return
+        batch = self.batch
+        batch.clear()
+        while changes:
+            key, value = changes.popleft()
+            batch[key] = value
+        for key, value in batch.items():
+            if key == 'brightness':
+                # Not part of the colour config, goes straight to WLED
+                state = json.dumps({"state": {"on": value > 0, "bri": value}})
+                self.data['serial'].write(state.encode('ascii'))
+            else:
+                setattr(self.config, key, value)
+
+    # OSC
+    def parseOsc(self, packet, start, end, stamp, depth=0):
+        self.packets += 1
+        try:
+            if packet.startswith(OSC_BUNDLE, start):
+                # Bundle: 8 byte time tag then size-prefixed elements. Time tags are ignored,
+                # everything is applied on arrival
+                if depth >= MAX_BUNDLE_DEPTH:
+                    self.errors += 1
+                    return
+                pos = start + 16
+                while pos + 4 <= end:
+                    size = UINT32.unpack_from(packet, pos)[0]
+                    pos += 4
+                    if size == 0 or pos + size > end:
+                        # A bad size would otherwise walk outside the bundle or never move on
+                        self.errors += 1
+                        return
+                    self.parseOsc(packet, pos, pos + size, stamp, depth + 1)
+                    pos += size
+                return
+            for address, handler in self.oscHandlers:
+                if packet.startswith(address, start):
+                    pos = start + padded(len(address))
+                    args = self.args
+                    args.clear()
+                    self.parseArgs(packet, pos, end, args)
+                    handler(args, stamp)
+                    return
+        except (struct.error, IndexError, ValueError, TypeError):
+            self.errors += 1
+
+    def parseArgs(self, packet, pos, end, args):
+        if pos >= end or packet[pos] != 0x2C:  # ','
+            return
+        tagStart = pos + 1
+        tagEnd = packet.index(0, tagStart)
+        pos += padded(tagEnd - pos + 1)
+        for i in range(tagStart, tagEnd):
+            tag = packet[i]
+            if tag == 0x69:  # i
+                args.append(INT32.unpack_from(packet, pos)[0])
+                pos += 4
+            elif tag == 0x66:  # f
+                args.append(FLOAT32.unpack_from(packet, pos)[0])
+                pos += 4
+            elif tag == 0x72 or tag == 0x6D:  # r (rgba colour) and m (midi message) are 4 raw bytes
+                args.append(UINT32.unpack_from(packet, pos)[0])
+                pos += 4
+            elif tag == 0x68:  # h
+                args.append(INT64.unpack_from(packet, pos)[0])
+                pos += 8
+            elif tag == 0x64:  # d
+                args.append(FLOAT64.unpack_from(packet, pos)[0])
+                pos += 8
+            elif tag == 0x73:  # s
+                stringEnd = packet.index(0, pos)
+                args.append(packet[pos:stringEnd].decode('ascii', 'replace'))
+                pos += padded(stringEnd - pos + 1)
+            elif tag == 0x54:  # T
+                args.append(True)
+            elif tag == 0x46:  # F
+                args.append(False)
+            else:
+                return
+
+    def oscNoteOn(self, args, stamp):
+        # /note/on note [velocity]
+        velocity = int(args[1]) if len(args) > 1 else 127
+        self.oscPort.push([0x90, int(args[0]) & 0x7F, velocity & 0x7F], stamp)
+
+    def oscNoteOff(self, args, stamp):
+        # A real note off. The merger turns it into a keyboard release, and only if the note is held
+        self.oscPort.push([0x80, int(args[0]) & 0x7F, 0], stamp)
+
+    def oscMidi(self, args, stamp):
+        # /midi m (port, status, data1, data2) or /midi status data1 [data2]
+        if len(args) == 1:
+            value = args[0]
+            status = (value >> 16) & 0xFF
+            message = [status, (value >> 8) & 0x7F, value & 0x7F]
+        else:
+            status = int(args[0]) & 0xFF
+            message = [status] + [int(arg) & 0x7F for arg in args[1:3]]
+        # Exactly the data bytes the status needs. Anything short would break handleMidiInput
+        if status < 0x80 or len(message) < 1 + dataLength(status):
+            self.errors += 1
+            return
+        del message[1 + dataLength(status):]
+        self.oscPort.push(message, stamp)
+
+    def oscMode(self, args, stamp):
+        if args and args[0] in midiToWLED.modes:
+            self.changes.append(('mode', args[0]))
+
+    def oscEffect(self, args, stamp):
+        if args and args[0] in ledEffects.effects:
+            self.changes.append(('effect', args[0]))
+
+    def oscBeat(self, args, stamp):
+        if args and args[0] in ledEffects.beatEffects:
+            self.changes.append(('beatEffect', args[0]))
+
+    def oscColor(self, args, stamp):
+        rgb = oscRGB(args)
+        if rgb is not None:
+            self.changes.append(('RGB', rgb))
+
+    def oscColor2(self, args, stamp):
+        rgb = oscRGB(args)
+        if rgb is not None:
+            self.changes.append(('RGB2', rgb))
+
+    def oscBrightness(self, args, stamp):
+        # 0-255, or a float from 0 to 1
+        if args:
+            value = args[0]
+            if isinstance(value, float):
+                value *= 255
+            self.changes.append(('brightness', max(0, min(255, int(value)))))
+
+    def oscBpm(self, args, stamp):
+        if args and 25 <= args[0] <= 300:
+            self.changes.append(('bpm', args[0]))
+
+    # Network MIDI
+    def parseNetMidi(self, packet, addr, transport, raw, stamp):
+        self.packets += 1
+        try:
+            if raw:
+                self.midiBytes(packet, 0, len(packet), False, stamp)
+            elif len(packet) >= 4 and packet[0] == 0xFF and packet[1] == 0xFF:
+                self.appleMidi(packet, addr, transport)
+            elif len(packet) > RTP_HEADER.size and packet[0] & 0xC0 == 0x80 and packet[1] & 0x7F == 0x61:
+                self.rtpMidi(packet, stamp)
+            else:
+                self.errors += 1
+        except (struct.error, IndexError, ValueError):
+            self.errors += 1
+
+    def appleMidi(self, packet, addr, transport):
+        # Just enough of the AppleMIDI session protocol for a network session to connect
+        command = packet[2:4]
+        if command == b'IN':
+            signature, command, version, token, ssrc = APPLE_MIDI.unpack_from(packet, 0)
+            transport.sendto(APPLE_MIDI.pack(0xFFFF, b'OK', 2, token, self.ssrc) + SESSION_NAME, addr)
+        elif command == b'CK':
+            signature, command, ssrc, count, ts1, ts2, ts3 = APPLE_CLOCK.unpack_from(packet, 0)
+            if count == 0:
+                now = int(time.perf_counter() * 10000)
+                transport.sendto(APPLE_CLOCK.pack(0xFFFF, b'CK', self.ssrc, 1, ts1, now, 0), addr)
+
+    def rtpMidi(self, packet, stamp):
+        # RTP header, then the MIDI command section: B J Z P LEN, and a MIDI list with delta times
+        pos = RTP_HEADER.size
+        flags = packet[pos]
+        if flags & 0x80:
+            length = ((flags & 0x0F) << 8) | packet[pos + 1]
+            pos += 2
+        else:
+            length = flags & 0x0F
+            pos += 1
+        self.midiBytes(packet, pos, min(pos + length, len(packet)), True, stamp, bool(flags & 0x20))
+
+    def midiBytes(self, packet, pos, end, deltas, stamp, firstDelta=False):
+        # Split a MIDI byte stream into messages, following running status. RTP MIDI lists put a
+        # delta time before every command but the first (unless the Z flag says it has one too)
+        commands = self.commands
+        commands.clear()
+        status = 0
+        first = True
+        ticks = 0
+        while pos < end:
+            if deltas and (firstDelta or not first):
+                # Variable length delta time, up to 4 bytes
+                delta = 0
+                for i in range(4):
+                    if pos >= end:
+                        break
+                    byte = packet[pos]
+                    pos += 1
+                    delta = (delta << 7) | (byte & 0x7F)
+                    if byte < 0x80:
+                        break
+                ticks += delta
+                if pos >= end:
+                    break
+            first = False
+            byte = packet[pos]
+            if byte == 0xF0:
+                # Skip system exclusive
+                close = packet.find(0xF7, pos, end)
+                if close < 0:
+                    # Unterminated, e.g. a segmented RTP MIDI SysEx. Nothing after it to read
+                    break
+                pos = close + 1
+                continue
+            if byte >= 0x80:
+                pos += 1
+                if byte < 0xF0:
+                    status = byte
+                elif byte < 0xF8:
+                    # System common cancels running status
+                    status = 0
+                current = byte
+            elif status:
+                current = status
+            else:
+                # Stray data byte
+                pos += 1
+                continue
+            count = dataLength(current)
+            if pos + count > end:
+                break
+            message = [current]
+            for i in range(count):
+                message.append(packet[pos + i])
+            pos += count
+            commands.append((ticks, message))
+        # Deltas count from the packet's RTP timestamp, and the packet goes out after its last
+        # command. So the last one lands at arrival and the rest keep their spacing before it,
+        # never earlier than what this port already queued so the queue stays in order
+        port = self.midiPort
+        for offset, message in commands:
+            at = stamp - (ticks - offset) / RTP_CLOCK_RATE
+            if port.clock is not None and at < port.clock:
+                at = port.clock
+            port.clock = at
+            port.push(message, at)
+
+    def summary(self):
+        return "net: %d packets, %d errors" % (self.packets, self.errors)
+
+
+# Helpers
+def padded(size):
+    # OSC strings and blobs are padded to a multiple of 4 bytes
+    return (size + 3) & ~3
+
+def oscRGB(args):
+    # /color r g b (ints 0-255 or floats 0-1), or a single 'r' rgba colour
+    if len(args) == 1 and isinstance(args[0], int):
+        value = args[0]
+        return [(value >> 24) & 0xFF, (value >> 16) & 0xFF, (value >> 8) & 0xFF]
+    if len(args) >= 3:
+        rgb = []
+        for value in args[:3]:
+            if isinstance(value, float):
+                value *= 255
+            rgb.append(max(0, min(255, int(value))))
+        return rgb
+    return None
@@ -0,0 +1,131 @@
+"""Runtime togglable per-stage timing and a sampling profiler that writes collapsed stacks."""
+
+import collections
+import functools
+import os
+import sys
+import threading
+import time
+
+import midiToWLED
+
+# Seconds between stack samples
+SAMPLE_INTERVAL = 0.005
+# How often the sampler refreshes thread names
+THREAD_REFRESH = 1.0
+
+
+class Profiler:
+    # Stage timing works by swapping timed wrappers in for the functions and methods that make up
+    # the pipeline while profiling is on, and putting the originals back when it is turned off.
+    # Nothing is checked or wrapped while disabled, so the hot path costs exactly what it did.
+    # Stage times are inclusive, e.g. color.velocity is also counted in color
+    def __init__(self):
+        self.enabled = False
+        self.stages = {}
+        self.patched = []
+        self.samples = collections.Counter()
+        self.sampler = None
+
+    def targets(self, data):
+        # (owner, attribute, stage) for everything that gets timed
+        targets = [
+            (midiToWLED, 'getRGBValue', 'color'),
+            (midiToWLED, 'getVelocityAwareRGB', 'color.velocity'),
+            (midiToWLED, 'getGradientRGB', 'color.gradient'),
+        ]
+        if data.get('midi') is not None:
+            targets.append((data['midi'], 'handler', 'midi'))
+        if data.get('effects') is not None:
+            targets.append((data['effects'], 'render', 'render'))
+        if data.get('link') is not None:
+            targets.append((data['link'], 'nextPayload', 'encode'))
+        if data.get('serial') is not None:
+            targets.append((data['serial'], 'write', 'serial'))
+        return targets
+
+    def enable(self, data):
+        if self.enabled:
+            return
+        for owner, attr, name in self.targets(data):
+            # Remember whether this was set on the object itself so disable() can tell
+            # whether to put it back or just remove the wrapper
+            own = attr in vars(owner)
+            original = getattr(owner, attr)
+            setattr(owner, attr, self.timed(name, original))
+            self.patched.append((owner, attr, original, own))
+        self.enabled = True
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+        self.sampler.start()
+        print("Profiling on.")
+
+    def disable(self):
+        if not self.enabled:
+            return
+        self.enabled = False
+        for owner, attr, original, own in reversed(self.patched):
+            if own:
+                setattr(owner, attr, original)
+            else:
+                delattr(owner, attr)
+        self.patched = []
+        self.sampler.join()
+        self.sampler = None
+        print("Profiling off.")
+
+    def reset(self):
+        for stats in self.stages.values():
+            stats[0] = 0
+            stats[1] = 0.0
+        self.samples.clear()
+
+    def timed(self, name, func):
+        stats = self.stages.setdefault(name, [0, 0.0])
+        clock = time.perf_counter
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats[0] += 1
+                stats[1] += clock() - start
+        return wrapper
+
+    def sample(self):
+        # Runs on its own thread while enabled: record every other thread's stack
+        me = threading.get_ident()
+        names = {}
+        lastRefresh = 0
+        while self.enabled:
+            now = time.perf_counter()
+            if now - lastRefresh > THREAD_REFRESH:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                lastRefresh = now
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stack.reverse()
+                self.samples[';'.join(stack)] += 1
+            time.sleep(SAMPLE_INTERVAL)
+
+    def dump(self, path):
+        # Collapsed stacks, one "thread;outer;...;inner count" line each, for flamegraph.pl or speedscope
+        with open(path, "w") as collapsed:
+            for stack, count in sorted(self.samples.items()):
+                collapsed.write("%s %d\n" % (stack, count))
+
+    def summary(self):
+        # One line of per-stage timings for the GUI
+        parts = []
+        for name, (calls, total) in sorted(self.stages.items()):
+            if calls:
+                parts.append("%s: %d calls, %.3f ms avg, %.2f s" % (name, calls, total / calls * 1000, total))
+        return " | ".join(parts)
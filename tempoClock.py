@@ -0,0 +1,227 @@
+"""MIDI clock tempo tracking and a hierarchical timer wheel for beat-synced effects."""
+
+import math
+import time
+
+# Timer wheel layout: LEVELS wheels of 2**BITS slots, RESOLUTION seconds per tick on the first
+# wheel. 4 wheels of 64 slots at 1 ms cover a bit over 4.5 hours
+RESOLUTION = 0.001
+BITS = 6
+SLOTS = 1 << BITS
+MASK = SLOTS - 1
+LEVELS = 4
+
+# MIDI clock
+CLOCKS_PER_BEAT = 24
+CLOCKS_PER_SIXTEENTH = 6
+BEATS_PER_BAR = 4
+# Clock intervals outside this range (bpm 25..1250) are glitches or transport gaps
+MIN_CLOCK_INTERVAL = 60 / (1250 * CLOCKS_PER_BEAT)
+MAX_CLOCK_INTERVAL = 60 / (25 * CLOCKS_PER_BEAT)
+# Smoothing for the clock interval average
+SMOOTHING = 0.1
+# Free running tempo when config.bpm isn't set
+DEFAULT_BPM = 120
+# No clock for this long means we're free running on the configured bpm again
+CLOCK_TIMEOUT = 0.5
+
+
+class Timer:
+    # A scheduled callback. Timers live in a circular doubly linked list per wheel slot,
+    # so inserting and cancelling never search
+    __slots__ = ('deadline', 'tick', 'callback', 'prev', 'next')
+
+    def __init__(self, deadline=None, tick=None, callback=None):
+        self.deadline = deadline
+        self.tick = tick
+        self.callback = callback
+        self.prev = self
+        self.next = self
+
+    def cancel(self):
+        if self.prev is not self:
+            self.prev.next = self.next
+            self.next.prev = self.prev
+            self.prev = self
+            self.next = self
+
+    def pending(self):
+        return self.prev is not self
+
+
+class TimerWheel:
+    # Hierarchical timer wheel (Varghese & Lauck). advance() is called from the render loop;
+    # timers fire on the first call at or after their tick and get their exact deadline, so
+    # effects can be drawn relative to the true beat time rather than the frame time
+    def __init__(self, now=None):
+        if now is None:
+            now = time.perf_counter()
+        self.current = int(now / RESOLUTION)
+        # Each slot is the sentinel of its timer list
+        self.wheels = [[Timer() for slot in range(SLOTS)] for level in range(LEVELS)]
+
+    def schedule(self, deadline, callback):
+        tick = math.ceil(deadline / RESOLUTION)
+        if tick <= self.current:
+            tick = self.current + 1
+        timer = Timer(deadline, tick, callback)
+        self.place(timer)
+        return timer
+
+    def place(self, timer):
+        delta = timer.tick - self.current
+        level = 0
+        while level < LEVELS - 1 and delta >= 1 << (BITS * (level + 1)):
+            level += 1
+        head = self.wheels[level][(timer.tick >> (BITS * level)) & MASK]
+        # Append to the end of the slot list
+        timer.prev = head.prev
+        timer.next = head
+        head.prev.next = timer
+        head.prev = timer
+
+    def detach(self, head):
+        # Move the whole slot list onto a new sentinel and return that. The list stays intact,
+        # so a callback can still cancel any timer on it
+        moved = Timer()
+        if head.next is not head:
+            moved.next = head.next
+            moved.prev = head.prev
+            moved.next.prev = moved
+            moved.prev.next = moved
+            head.next = head
+            head.prev = head
+        return moved
+
+    def advance(self, now):
+        target = int(now / RESOLUTION)
+        while self.current < target:
+            self.current += 1
+            if self.current & MASK == 0:
+                # The first wheel wrapped. Move the next slot of each higher wheel down
+                for level in range(1, LEVELS):
+                    index = (self.current >> (BITS * level)) & MASK
+                    moved = self.detach(self.wheels[level][index])
+                    while moved.next is not moved:
+                        timer = moved.next
+                        timer.cancel()
+                        self.place(timer)
+                    if index != 0:
+                        break
+            due = self.detach(self.wheels[0][self.current & MASK])
+            while due.next is not due:
+                # Unlink each timer before its callback runs. Callbacks may cancel the others
+                timer = due.next
+                timer.cancel()
+                if timer.tick <= self.current:
+                    timer.callback(timer.deadline)
+                else:
+                    # Came down from the top wheel but is still a lap or more away
+                    self.place(timer)
+
+
+class TempoClock:
+    # Follows MIDI clock (0xF8), start/continue/stop and song position to know the tempo and
+    # where the beat is. Beats are scheduled ahead on the timer wheel from the current tempo and
+    # corrected whenever a clock tick lands on a beat. Without a clock it free runs on config.bpm
+    def __init__(self, scheduler, onBeat, config):
+        self.scheduler = scheduler
+        self.onBeat = onBeat
+        self.config = config
+        self.clockInterval = 60 / (self.freeBpm() * CLOCKS_PER_BEAT)
+        self.bpm = self.freeBpm()
+        self.synced = False
+        self.transport = False
+        self.playing = False
+        self.clocks = 0
+        self.lastClock = None
+        self.lastBeat = None
+        self.beatCount = -1
+        self.beatTimer = None
+
+    def freeBpm(self):
+        return self.config.bpm or DEFAULT_BPM
+
+    def beatLength(self):
+        if self.synced:
+            return self.clockInterval * CLOCKS_PER_BEAT
+        return 60 / self.freeBpm()
+
+    def start(self, now):
+        # Free run until a clock shows up
+        self.scheduleBeat(now + self.beatLength())
+
+    def stop(self):
+        if self.beatTimer is not None:
+            self.beatTimer.cancel()
+            self.beatTimer = None
+
+    def scheduleBeat(self, deadline):
+        self.stop()
+        self.beatTimer = self.scheduler.schedule(deadline, self.fireBeat)
+
+    def fireBeat(self, deadline):
+        # Predicted beat from the timer wheel
+        self.beatTimer = None
+        if self.synced and self.lastClock is not None and deadline - self.lastClock > CLOCK_TIMEOUT:
+            # Clock went away. Fall back to free running
+            self.synced = False
+            self.bpm = self.freeBpm()
+        # Stay quiet after a transport stop until start or continue, even once the clock is gone
+        if self.playing or not self.transport:
+            self.beat(deadline)
+        # Keep a timer going while stopped too, so a clock that goes away is noticed
+        self.scheduleBeat(deadline + self.beatLength())
+
+    def beat(self, stamp):
+        self.beatCount += 1
+        self.lastBeat = stamp
+        self.onBeat(stamp, self.beatLength(), self.beatCount)
+
+    def onMessage(self, message, stamp):
+        status = message[0]
+        if status == 0xF8:
+            if self.lastClock is not None:
+                interval = stamp - self.lastClock
+                if MIN_CLOCK_INTERVAL < interval < MAX_CLOCK_INTERVAL:
+                    self.clockInterval += SMOOTHING * (interval - self.clockInterval)
+                    self.bpm = 60 / (self.clockInterval * CLOCKS_PER_BEAT)
+            self.lastClock = stamp
+            self.synced = True
+            if not self.transport:
+                # Clock without start/stop messages. Treat it as playing
+                self.playing = True
+            if self.playing:
+                if self.clocks % CLOCKS_PER_BEAT == 0:
+                    beatLength = self.beatLength()
+                    if self.lastBeat is not None and abs(stamp - self.lastBeat) < beatLength / 4:
+                        # The wheel already fired this beat. Just pull it onto the clock
+                        self.lastBeat = stamp
+                        self.onBeat(stamp, beatLength, self.beatCount)
+                    else:
+                        self.beat(stamp)
+                    self.scheduleBeat(stamp + beatLength)
+                self.clocks += 1
+        elif status == 0xFA:
+            # Start: the next clock is the first beat of the song
+            self.clocks = 0
+            self.lastBeat = None
+            self.beatCount = -1
+            self.transport = True
+            self.playing = True
+        elif status == 0xFB:
+            self.transport = True
+            self.playing = True
+        elif status == 0xFC:
+            self.transport = True
+            self.playing = False
+        elif status == 0xF2 and len(message) > 2:
+            # Song position pointer counts sixteenth notes. Count so the next beat gets the right number
+            self.clocks = (message[1] | (message[2] << 7)) * CLOCKS_PER_SIXTEENTH
+            self.beatCount = -(-self.clocks // CLOCKS_PER_BEAT) - 1
+
+    def summary(self):
+        # One line of tempo info for the GUI
+        source = 'clock' if self.synced else 'free'
+        beat = max(self.beatCount, 0)
+        return "%.1f bpm (%s) | bar %d beat %d" % (self.bpm if self.synced else self.freeBpm(), source, beat // BEATS_PER_BAR + 1, beat % BEATS_PER_BAR + 1)